@@ -1,19 +1,28 @@
 import asyncio
 import logging
 import os
-import re
-from typing import Any, Dict
+from bisect import bisect_right
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import accumulate
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
 
 from aiogram import Bot, Dispatcher, F
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.types import (
     Message,
+    BufferedInputFile,
     FSInputFile,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     CallbackQuery,
 )
 
+from aiolimiter import AsyncLimiter
+
 from .config import settings
 from .logging_config import setup_logging
 from .cache_manager import cache_manager
@@ -23,10 +32,58 @@ from .plot_generator import generate_plots
 from .extended_summary import build_extended_summary
 from .pdf_builder import build_pdf_report
 
-# Разрешаем rs/RS, префикс rs + цифры
-RSID_REGEX = re.compile(r"^rs\d+$", re.IGNORECASE)
-
 REPORTS_DIR = "reports"  # будет /app/reports внутри контейнера
+REPORTS_PATH = Path(REPORTS_DIR)  # каталог создаётся один раз в main()
+
+# PDF меньше этого размера хранится в Redis вместе с результатом
+MAX_CACHED_PDF_SIZE = 512 * 1024
+
+# Поток для generate_plots: фигуры Matplotlib общие и всё равно рисуются под локом
+_PLOTS_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="plots")
+# Отдельный пул для build_pdf_report: поток PDF ждёт графики из _PLOTS_EXECUTOR
+# и не должен занимать пул по умолчанию, которым пользуется asyncio.to_thread
+_PDF_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="pdf")
+
+# rsid -> (future с payload без PDF, задача полного расчёта):
+# одновременные cache miss одного rsID считают результат один раз
+_INFLIGHT: Dict[
+    str, Tuple["asyncio.Future[Dict[str, Any]]", "asyncio.Task[Dict[str, Any]]"]
+] = {}
+
+# Лимит запросов пользователя; читаем настройку один раз при импорте
+MAX_REQUESTS_PER_HOUR = settings.max_requests_per_hour
+
+# Лимит Telegram ~4096 символов на сообщение, оставляем небольшой запас
+MAX_MESSAGE_LEN = 3500
+
+# Общий на весь бот лимит отправки: Telegram допускает ~30 сообщений/с, оставляем запас
+_TELEGRAM_LIMITER = AsyncLimiter(25, 1)
+
+# Шаблоны текстового блока общей информации
+_BASIC_TMPL = (
+    "🔬 Общая информация:\n"
+    "  Ген(ы): {genes}\n"
+    "  Тип варианта: {variant_type}"
+)
+_LOCUS_TMPL = "\n  Локус (GRCh38): chr{chrom}:{pos38}"
+_HGVS_C_TMPL = "\n  HGVS (c.): {hgvs_c}"
+_HGVS_P_TMPL = "\n  HGVS (p.): {hgvs_p}"
+_REGION_TMPL = "\n  Регион: {region}"
+
+# Шаблоны текстового блока одной популяции
+_POP_TMPL = (
+    "Исследование / популяция: {study}\n"
+    "  Референсный аллель: {ref_allele} (частота: {freq_ref:.6f})\n"
+    "  Альтернативный аллель: {alt_allele} (частота: {freq_alt:.6f})"
+)
+_GENO_TMPL = (
+    "\n  Ожидаемые частоты генотипов (Hardy–Вайнберг):\n"
+    "    0/0: {hom_ref:.6f}\n"
+    "    0/1: {het:.6f}\n"
+    "    1/1: {hom_alt:.6f}"
+)
+_MAF_TMPL = "\n  MAF: {maf:.6f} (категория: {category})"
+_SAMPLE_N_TMPL = "\n  Размер выборки (N): {sample_n}"
 
 EXAMPLE_RSIDS = [
     "rs1801133",  # MTHFR
@@ -36,78 +93,78 @@ EXAMPLE_RSIDS = [
     "rs7903146",  # TCF7L2
 ]
 
+# --- Статические ответы: собираем один раз при импорте ---
 
-async def handle_start(message: Message) -> None:
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(
-                    text="Пример rs1801133",
-                    callback_data="example:rs1801133",
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    text="Пример rs429358",
-                    callback_data="example:rs429358",
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    text="Пример rs7412",
-                    callback_data="example:rs7412",
-                )
-            ],
+# На стартовой клавиатуре — первые три примера
+_START_KB = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(
+                text=f"Пример {rsid}",
+                callback_data=f"example:{rsid}",
+            )
         ]
-    )
+        for rsid in EXAMPLE_RSIDS[:3]
+    ]
+)
+
+_START_TEXT = (
+    "Привет! Я бот для анализа частот генетических вариантов по rsID.\n\n"
+    "Основная команда:\n"
+    "  /get rs12345 — получить данные по указанному rsID\n\n"
+    "Формат rsID:\n"
+    "  • префикс 'rs' (регистр неважен)\n"
+    "  • затем только цифры\n"
+    "Пример: /get rs1801133\n\n"
+    "Для демонстрации можете нажать на одну из кнопок с примерами ниже."
+)
+
+_HELP_TEXT = (
+    "/start — краткое приветствие и инструкция\n"
+    "/help — подробная справка по использованию бота\n"
+    "/get <rsid> — получить данные по rsID\n"
+    "    Формат: /get rs12345 (префикс rs + цифры)\n"
+    "    Пример: /get rs1801133\n\n"
+    "/history — показать ваши запросы за последние 24 часа\n"
+    "/about — информация о боте\n"
+    "/stop — остановить взаимодействие с ботом (бот больше не будет отвечать до новых команд)"
+)
+
+_ABOUT_TEXT = (
+    "SNP Frequency Bot\n\n"
+    "Источник данных:\n"
+    " • NCBI dbSNP API (https://api.ncbi.nlm.nih.gov/variation/v0/refsnp/)\n\n"
+    "Что делает бот:\n"
+    " • Получает популяционные частоты аллелей по rsID\n"
+    " • По упрощённой модели Харди–Вайнберга рассчитывает частоты генотипов\n"
+    " • Строит графики распределения частот\n\n"
+    "Ограничения:\n"
+    f" • Не более {MAX_REQUESTS_PER_HOUR} запросов в час на пользователя\n"
+    " • Данные зависят от актуальности и полноты баз NCBI\n"
+    " • Возможны различия между исследованиями/популяциями\n\n"
+    "Дисклеймер:\n"
+    " • Бот не предназначен для постановки диагнозов или назначения лечения\n"
+    " • Информация носит исключительно ознакомительный и образовательный характер\n"
+    " • По вопросам интерпретации результатов обращайтесь к врачу/генетику."
+)
+
+_STOP_TEXT = (
+    "Останавливаю взаимодействие.\n"
+    "Бот не будет отправлять новые ответы, пока вы не введёте команду снова "
+    "(/start, /get и т.п.)."
+)
 
-    text = (
-        "Привет! Я бот для анализа частот генетических вариантов по rsID.\n\n"
-        "Основная команда:\n"
-        "  /get rs12345 — получить данные по указанному rsID\n\n"
-        "Формат rsID:\n"
-        "  • префикс 'rs' (регистр неважен)\n"
-        "  • затем только цифры\n"
-        "Пример: /get rs1801133\n\n"
-        "Для демонстрации можете нажать на одну из кнопок с примерами ниже."
-    )
 
-    await message.answer(text, reply_markup=keyboard)
+async def handle_start(message: Message) -> None:
+    await message.answer(_START_TEXT, reply_markup=_START_KB)
 
 
 async def handle_help(message: Message) -> None:
-    text = (
-        "/start — краткое приветствие и инструкция\n"
-        "/help — подробная справка по использованию бота\n"
-        "/get <rsid> — получить данные по rsID\n"
-        "    Формат: /get rs12345 (префикс rs + цифры)\n"
-        "    Пример: /get rs1801133\n\n"
-        "/history — показать ваши запросы за последние 24 часа\n"
-        "/about — информация о боте\n"
-        "/stop — остановить взаимодействие с ботом (бот больше не будет отвечать до новых команд)"
-    )
-    await message.answer(text)
+    await message.answer(_HELP_TEXT)
 
 
 async def handle_about(message: Message) -> None:
-    text = (
-        "SNP Frequency Bot\n\n"
-        "Источник данных:\n"
-        " • NCBI dbSNP API (https://api.ncbi.nlm.nih.gov/variation/v0/refsnp/)\n\n"
-        "Что делает бот:\n"
-        " • Получает популяционные частоты аллелей по rsID\n"
-        " • По упрощённой модели Харди–Вайнберга рассчитывает частоты генотипов\n"
-        " • Строит графики распределения частот\n\n"
-        "Ограничения:\n"
-        f" • Не более {settings.max_requests_per_hour} запросов в час на пользователя\n"
-        " • Данные зависят от актуальности и полноты баз NCBI\n"
-        " • Возможны различия между исследованиями/популяциями\n\n"
-        "Дисклеймер:\n"
-        " • Бот не предназначен для постановки диагнозов или назначения лечения\n"
-        " • Информация носит исключительно ознакомительный и образовательный характер\n"
-        " • По вопросам интерпретации результатов обращайтесь к врачу/генетику."
-    )
-    await message.answer(text)
+    await message.answer(_ABOUT_TEXT)
 
 
 async def handle_history(message: Message) -> None:
@@ -127,11 +184,11 @@ async def _process_rsid(message: Message, rsid: str, uid: int | None = None) ->
     # --- rate limiting на пользователя ---
     allowed, remaining = await cache_manager.register_request_and_check_limit(
         user_id=message.from_user.id,
-        limit=settings.max_requests_per_hour,
+        limit=MAX_REQUESTS_PER_HOUR,
     )
     if not allowed:
         await message.answer(
-            f"Вы превысили лимит {settings.max_requests_per_hour} запросов в час.\n"
+            f"Вы превысили лимит {MAX_REQUESTS_PER_HOUR} запросов в час.\n"
             "Попробуйте позже."
         )
         return
@@ -146,16 +203,25 @@ async def _process_rsid(message: Message, rsid: str, uid: int | None = None) ->
     await message.answer(f"Запрашиваю данные для {rsid}...")
 
     # --- 1. Пробуем использовать кэш ---
-    cached = await cache_manager.get_snp_result(rsid)
-    if cached:
-        logging.info("Cache hit for %s", rsid)
-        await cache_manager.add_history_entry(user_id, rsid)
-        await _send_result(message, cached)
-        return
+    # Если rsID уже считается, в Redis может лежать результат ещё без PDF —
+    # тогда кэш не читаем, а присоединяемся к расчёту
+    if rsid not in _INFLIGHT:
+        cached = await cache_manager.get_snp_result_and_add_history(rsid, user_id)
+        if cached:
+            logging.info("Cache hit for %s", rsid)
+            await _send_result(message, cached)
+            return
+
+    # --- 2. Один расчёт на rsID: одновременные cache miss ждут ту же задачу ---
+    # (пока ждали Redis, расчёт мог начать другой запрос)
+    entry = _INFLIGHT.get(rsid)
+    if entry is None:
+        entry = _start_build(rsid)
+    base_future, build_task = entry
 
-    # --- 2. Запрос к NCBI ---
     try:
-        raw = await ncbi_client.fetch_snp(rsid)
+        # shield: отмена одного ожидающего не отменяет расчёт для остальных
+        payload = await asyncio.shield(base_future)
     except ncbi_client.SnpNotFoundError:
         await message.answer(f"Вариант {rsid} не найден в NCBI dbSNP.")
         return
@@ -168,152 +234,306 @@ async def _process_rsid(message: Message, rsid: str, uid: int | None = None) ->
         await message.answer("Ошибка при обращении к NCBI API.")
         return
 
-    # --- 3. Базовый summary + графики ---
-    summary = summarize_snp(rsid, raw)
-    images = generate_plots(summary)
+    # --- 3. Текст пользователю, пока собирается PDF, + история ---
+    has_text, _ = await asyncio.gather(
+        _send_text_part(message, payload),
+        cache_manager.add_history_entry(user_id, rsid),
+    )
 
-    # --- 4. Расширенная аналитика ---
-    extended_summary = build_extended_summary(rsid, raw, summary)
+    # --- 4. Картинки и PDF ---
+    result = await asyncio.shield(build_task)
+    if has_text:
+        await _send_media(message, result)
+
+
+def _start_build(
+    rsid: str,
+) -> Tuple["asyncio.Future[Dict[str, Any]]", "asyncio.Task[Dict[str, Any]]"]:
+    loop = asyncio.get_running_loop()
+    base_future: "asyncio.Future[Dict[str, Any]]" = loop.create_future()
+    build_task = asyncio.create_task(_build_result(rsid, base_future))
+    entry = (base_future, build_task)
+    _INFLIGHT[rsid] = entry
+
+    def _done(task: "asyncio.Task[Dict[str, Any]]") -> None:
+        if _INFLIGHT.get(rsid) is entry:
+            del _INFLIGHT[rsid]
+        # Ошибку задачи забираем здесь: если расчёт упал до base_future,
+        # ожидающие получили её оттуда и саму задачу уже не ждут
+        if not task.cancelled():
+            task.exception()
+
+    build_task.add_done_callback(_done)
+    return entry
+
+
+async def _build_result(
+    rsid: str,
+    base_future: "asyncio.Future[Dict[str, Any]]",
+) -> Dict[str, Any]:
+    """
+    Полный расчёт по rsID на cache miss: NCBI, summary, графики, PDF, кэш.
+
+    base_future получает payload без PDF, как только он готов, — текст
+    можно отправлять, пока собирается отчёт. Возвращает payload с PDF.
+    """
+    try:
+        # --- Запрос к NCBI ---
+        raw = await ncbi_client.fetch_snp(rsid)
 
-    # --- 5. Генерация PDF-отчёта ---
-    os.makedirs(REPORTS_DIR, exist_ok=True)
-    pdf_path = os.path.join(REPORTS_DIR, f"{rsid}.pdf")
-    build_pdf_report(rsid, extended_summary, images, pdf_path)
-
-    # --- 6. Собираем payload для кэша ---
-    payload: Dict[str, Any] = {
-        "rsid": rsid,
-        "populations": [p.to_dict() for p in summary.populations],
-        "extended_summary": extended_summary,
-        "images": images,
-        "pdf": pdf_path,
-    }
+        # --- Базовый summary; графики рендерятся в отдельном потоке ---
+        summary = summarize_snp(rsid, raw)
+        plots_future = _PLOTS_EXECUTOR.submit(generate_plots, summary)
+
+        # --- Расширенная аналитика ---
+        extended_summary = build_extended_summary(rsid, raw, summary)
+
+        # PDF начинаем собирать сразу: текстовая часть строится, пока рисуются графики,
+        # а сами графики build_pdf_report дождётся через plots_future.result
+        pdf_path = str(REPORTS_PATH / f"{rsid}.pdf")
+        pdf_task = asyncio.get_running_loop().run_in_executor(
+            _PDF_EXECUTOR,
+            build_pdf_report,
+            rsid,
+            extended_summary,
+            plots_future.result,
+            pdf_path,
+        )
+        try:
+            images = await asyncio.wrap_future(plots_future)
+        except Exception:
+            # build_pdf_report упадёт на той же ошибке — забираем её из pdf_task
+            await asyncio.gather(pdf_task, return_exceptions=True)
+            raise
+
+        # --- Payload для кэша ---
+        # Путь к PDF в payload не кладём, пока отчёт не собран: параллельный cache hit
+        # не должен отправить недописанный файл
+        payload: Dict[str, Any] = {
+            "rsid": rsid,
+            "populations": [p.to_dict() for p in summary.populations],
+            "extended_summary": extended_summary,
+            "images": images,
+        }
+    except BaseException as e:
+        if isinstance(e, asyncio.CancelledError):
+            base_future.cancel()
+        else:
+            base_future.set_exception(e)
+        raise
+    base_future.set_result(payload)
     logging.info(f"Caching the request...")
 
-    # --- 7. Кэш + история ---
-    await cache_manager.set_snp_result(rsid, payload)
-    await cache_manager.add_history_entry(user_id, rsid)
+    # --- Параллельно: PDF (в потоке) и кэш ---
+    pdf_result, persist_result = await asyncio.gather(
+        pdf_task,
+        cache_manager.set_snp_result(rsid, payload),
+        return_exceptions=True,
+    )
+    if isinstance(persist_result, BaseException):
+        raise persist_result
+    if isinstance(pdf_result, BaseException):
+        # Результат без отчёта в кэше не оставляем (удаляем только то, что записали сами)
+        await cache_manager.delete_incomplete_result(rsid)
+        raise pdf_result
+
+    # --- Небольшой PDF кладём в кэш целиком: его сможет отдать любая реплика ---
+    pdf_fields: Dict[str, Any] = {"pdf": pdf_path}
+    pdf_bytes = await asyncio.to_thread(_read_small_pdf, pdf_path)
+    if pdf_bytes is not None:
+        pdf_fields["pdf_bytes"] = pdf_bytes
+    await cache_manager.set_snp_fields(rsid, pdf_fields)
 
-    # --- 8. Отправка результата ---
-    await _send_result(message, payload)
+    return {**payload, **pdf_fields}
 
 
 async def _send_result(message: Message, payload: Dict[str, Any]) -> None:
+    if await _send_text_part(message, payload):
+        await _send_media(message, payload)
+
+
+async def _send_text_part(message: Message, payload: Dict[str, Any]) -> bool:
+    """
+    Отправляет текстовую часть результата.
+    Возвращает False, если частот нет и отправлять картинки/PDF не нужно.
+    """
     rsid = payload.get("rsid", "-")
     pops = payload.get("populations") or []
     extended = payload.get("extended_summary") or {}
 
     if not pops:
         await message.answer(f"Не удалось извлечь частоты для {rsid}.")
-        return
+        return False
 
-    lines: list[str] = [f"РЕЗУЛЬТАТЫ ДЛЯ {rsid}", ""]
+    # Каждый блок заканчивается '\n' — после склейки через '\n' это пустая строка-разделитель
+    blocks: List[str] = [f"РЕЗУЛЬТАТЫ ДЛЯ {rsid}\n"]
 
     # --- Блок: общая информация, если есть extended_summary ---
     basic = extended.get("basic_info") or {}
     if basic:
-        genes_list = basic.get("genes") or []
-        genes = ", ".join(genes_list) if genes_list else "-"
-        lines.append("🔬 Общая информация:")
-        lines.append(f"  Ген(ы): {genes}")
-        lines.append(f"  Тип варианта: {basic.get('variant_type', '-')}")
-        chrom = basic.get("chrom", "-")
-        pos38 = basic.get("pos38", "-")
-        if chrom != "-" or pos38 != "-":
-            lines.append(f"  Локус (GRCh38): chr{chrom}:{pos38}")
-        hgvs_c = basic.get("hgvs_c", "-")
-        hgvs_p = basic.get("hgvs_p", "-")
-        if hgvs_c not in ("", "-"):
-            lines.append(f"  HGVS (c.): {hgvs_c}")
-        if hgvs_p not in ("", "-"):
-            lines.append(f"  HGVS (p.): {hgvs_p}")
-        region = basic.get("region")
-        if region and region != "-":
-            lines.append(f"  Регион: {region}")
-        lines.append("")
+        blocks.append(_format_basic_info(basic))
 
     # --- Блок: популяционные частоты ---
-    lines.append("📊 Популяционные частоты:")
-    lines.append("")
+    blocks.append("📊 Популяционные частоты:\n")
 
-    # extended-популяции индексируем по имени (study/name)
-    ext_pops: Dict[str, Dict[str, Any]] = {}
-    for ep in extended.get("populations", []):
-        if isinstance(ep, dict) and "name" in ep:
-            ext_pops[ep["name"]] = ep
+    # extended-популяции индексируем по имени (study/name);
+    # битые записи из старых кэшей — просто без доп. информации
+    try:
+        ext_pops: Dict[str, Dict[str, Any]] = {
+            ep["name"]: ep for ep in extended.get("populations", ())
+        }
+    except (KeyError, TypeError):
+        ext_pops = {}
 
     for p in pops:
-        study = p.get("study", "unknown")
-        lines.append(f"Исследование / популяция: {study}")
-        lines.append(
-            f"  Референсный аллель: {p.get('ref_allele')} "
-            f"(частота: {p.get('freq_ref'):.6f})"
-        )
-        lines.append(
-            f"  Альтернативный аллель: {p.get('alt_allele')} "
-            f"(частота: {p.get('freq_alt'):.6f})"
-        )
-
-        gf = p.get("genotype_freqs")
-        if isinstance(gf, dict):
-            lines.append("  Ожидаемые частоты генотипов (Hardy–Вайнберг):")
-            lines.append(f"    0/0: {gf.get('hom_ref'):.6f}")
-            lines.append(f"    0/1: {gf.get('het'):.6f}")
-            lines.append(f"    1/1: {gf.get('hom_alt'):.6f}")
-
-        # Дополнительная инфа из extended_summary (MAF, N, категория)
-        ext = ext_pops.get(study)
-        if ext:
-            maf = ext.get("maf")
-            if maf is not None:
-                lines.append(
-                    f"  MAF: {maf:.6f} "
-                    f"(категория: {ext.get('category', '-')})"
-                )
-            sample_n = ext.get("sample_n")
-            if sample_n:
-                lines.append(f"  Размер выборки (N): {sample_n}")
-
-        lines.append("")
+        blocks.append(_format_population(p, ext_pops.get(p.get("study", "unknown"))))
 
     # --- Блок: предупреждения (если есть) ---
     warnings = extended.get("warnings") or []
     if warnings:
-        lines.append("⚠ Предупреждения:")
-        for w in warnings:
-            lines.append(f"  - {w}")
-        lines.append("")
+        blocks.append(
+            "⚠ Предупреждения:\n" + "".join(f"  - {w}\n" for w in warnings)
+        )
 
     # --- Отправка текста чанками (ограничение Telegram ~4096 символов) ---
-    max_len = 3500  # небольшой запас
-    chunk_lines: list[str] = []
-    current_len = 0
-
-    for line in lines:
-        add_len = len(line) + 1  # +1 за '\n'
-        if current_len + add_len > max_len and chunk_lines:
-            await message.answer("\n".join(chunk_lines))
-            chunk_lines = []
-            current_len = 0
-        chunk_lines.append(line)
-        current_len += add_len
-
-    if chunk_lines:
-        await message.answer("\n".join(chunk_lines))
-
-    # --- Отправляем картинки ---
+    for chunk in _split_into_chunks(blocks):
+        await _send_limited(partial(message.answer, chunk))
+
+    return True
+
+
+def _format_basic_info(basic: Dict[str, Any]) -> str:
+    fields = defaultdict(lambda: "-", basic)
+    genes_list = basic.get("genes") or []
+    fields["genes"] = ", ".join(genes_list) if genes_list else "-"
+
+    block = _BASIC_TMPL.format_map(fields)
+    if fields["chrom"] != "-" or fields["pos38"] != "-":
+        block += _LOCUS_TMPL.format_map(fields)
+    if fields["hgvs_c"] not in ("", "-"):
+        block += _HGVS_C_TMPL.format_map(fields)
+    if fields["hgvs_p"] not in ("", "-"):
+        block += _HGVS_P_TMPL.format_map(fields)
+    if basic.get("region") and fields["region"] != "-":
+        block += _REGION_TMPL.format_map(fields)
+    return block + "\n"
+
+
+def _format_population(p: Dict[str, Any], ext: Dict[str, Any] | None) -> str:
+    block = _POP_TMPL.format_map(defaultdict(lambda: "-", p))
+
+    gf = p.get("genotype_freqs")
+    if isinstance(gf, dict):
+        block += _GENO_TMPL.format_map(gf)
+
+    # Дополнительная инфа из extended_summary (MAF, N, категория)
+    if ext:
+        maf = ext.get("maf")
+        if maf is not None:
+            block += _MAF_TMPL.format(maf=maf, category=ext.get("category", "-"))
+        sample_n = ext.get("sample_n")
+        if sample_n:
+            block += _SAMPLE_N_TMPL.format(sample_n=sample_n)
+
+    return block + "\n"
+
+
+async def _send_limited(send: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Выполняет отправку в рамках _TELEGRAM_LIMITER.
+    При TelegramRetryAfter ждёт указанное Telegram время и повторяет.
+    """
+    while True:
+        async with _TELEGRAM_LIMITER:
+            try:
+                return await send()
+            except TelegramRetryAfter as e:
+                retry_after = e.retry_after
+        logging.warning("Telegram flood control, retry in %s s", retry_after)
+        await asyncio.sleep(retry_after)
+
+
+def _split_into_chunks(lines: List[str], max_len: int = MAX_MESSAGE_LEN) -> List[str]:
+    """
+    Склеивает строки в сообщения длиной не более max_len.
+    Границы чанков ищутся бинарным поиском по префиксным суммам длин
+    (+1 за '\n' на каждую строку). Строка длиннее max_len уходит отдельным чанком.
+    """
+    ends = list(accumulate(len(line) + 1 for line in lines))
+    chunks: List[str] = []
+    start = 0
+    offset = 0
+    while start < len(lines):
+        stop = max(bisect_right(ends, offset + max_len, lo=start), start + 1)
+        chunks.append("\n".join(lines[start:stop]))
+        offset = ends[stop - 1]
+        start = stop
+    return chunks
+
+
+def _existing_paths(paths: List[str]) -> List[str]:
+    return [p for p in paths if p and os.path.exists(p)]
+
+
+def _read_small_pdf(pdf_path: str) -> bytes | None:
+    """
+    Содержимое PDF, если он меньше MAX_CACHED_PDF_SIZE; иначе None
+    (большие отчёты отдаются с диска по пути из кэша).
+    """
+    try:
+        if os.path.getsize(pdf_path) >= MAX_CACHED_PDF_SIZE:
+            return None
+        with open(pdf_path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+async def _send_media(message: Message, payload: Dict[str, Any]) -> None:
+    rsid = payload.get("rsid", "-")
     images = payload.get("images") or []
-    for img_path in images:
-        if img_path and os.path.exists(img_path):
-            await message.answer_photo(FSInputFile(img_path))
+    pdf_bytes = payload.get("pdf_bytes")
+    # Если PDF лежит в кэше, с диска его не читаем
+    pdf_path = None if pdf_bytes else payload.get("pdf")
+
+    # Проверяем наличие файлов одним вызовом в потоке, чтобы не блокировать event loop
+    candidates = [*images, pdf_path]
+    if len(candidates) > 1:
+        existing = set(await asyncio.to_thread(_existing_paths, candidates))
+    else:
+        existing = set(_existing_paths(candidates))
+
+    # --- Отправляем картинки (параллельно, в пределах общего лимита) ---
+    await asyncio.gather(
+        *(
+            _send_limited(partial(message.answer_photo, FSInputFile(img_path)))
+            for img_path in images
+            if img_path in existing
+        )
+    )
 
     # --- Отправляем PDF, если есть ---
-    pdf_path = payload.get("pdf")
-    if pdf_path and os.path.exists(pdf_path):
-        await message.answer_document(
-            FSInputFile(pdf_path),
-            caption=f"PDF-отчёт по {rsid}",
+    if pdf_bytes:
+        await _send_limited(
+            partial(
+                message.answer_document,
+                BufferedInputFile(pdf_bytes, filename=f"{rsid}.pdf"),
+                caption=f"PDF-отчёт по {rsid}",
+            )
         )
+    elif pdf_path in existing:
+        await _send_limited(
+            partial(
+                message.answer_document,
+                FSInputFile(pdf_path),
+                caption=f"PDF-отчёт по {rsid}",
+            )
+        )
+
+
+def _is_valid_rsid(s: str) -> bool:
+    # Разрешаем rs/RS, префикс rs + цифры (простая проверка вместо регулярки)
+    return len(s) >= 3 and s[0] in "rR" and s[1] in "sS" and s[2:].isdecimal()
 
 
 async def handle_get(message: Message) -> None:
@@ -323,7 +543,7 @@ async def handle_get(message: Message) -> None:
         return
 
     rsid = parts[1].strip()
-    if not RSID_REGEX.match(rsid):
+    if not _is_valid_rsid(rsid):
         await message.answer("Неверный формат rsID. Пример: rs7755898")
         return
 
@@ -331,12 +551,7 @@ async def handle_get(message: Message) -> None:
 
 
 async def handle_stop(message: Message) -> None:
-    text = (
-        "Останавливаю взаимодействие.\n"
-        "Бот не будет отправлять новые ответы, пока вы не введёте команду снова "
-        "(/start, /get и т.п.)."
-    )
-    await message.answer(text)
+    await message.answer(_STOP_TEXT)
 
 
 async def handle_example_callback(callback: CallbackQuery) -> None:
@@ -357,6 +572,8 @@ async def main() -> None:
     if not settings.telegram_token:
         raise RuntimeError("TELEGRAM_BOT_TOKEN is not set")
 
+    os.makedirs(REPORTS_DIR, exist_ok=True)
+
     bot = Bot(token=settings.telegram_token)
     dp = Dispatcher()
 
@@ -370,7 +587,10 @@ async def main() -> None:
     dp.callback_query.register(handle_example_callback, F.data.startswith("example:"))
 
     logging.info("Bot starting...")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await ncbi_client.close_session()
 
 
 if __name__ == "__main__":
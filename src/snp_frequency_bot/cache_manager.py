@@ -1,12 +1,111 @@
-import json
 import time
 import logging
-from typing import Optional, List, Tuple
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
+import orjson
 import redis.asyncio as redis
 
 from .config import settings
 
+_HOUR = 3600
+_DAY = 86400
+_HIST_TTL = 2 * _DAY  # история живёт 2 дня, показываем последние 24 часа
+
+# Локальный (in-process) кэш поверх Redis для "горячих" rsID
+_LOCAL_MAX = 256
+_LOCAL_TTL = 300  # 5 минут
+
+# Поля payload; в Redis каждое хранится отдельным полем HASH snp:{rsid}:v2
+SNP_FIELDS: Tuple[str, ...] = (
+    "rsid",
+    "populations",
+    "extended_summary",
+    "images",
+    "pdf",
+    "pdf_bytes",
+)
+
+# Поля, которые хранятся как есть (bytes), без JSON
+_RAW_FIELDS = frozenset({"pdf_bytes"})
+
+# Без этого поля HASH не считается результатом (например, остался только pdf_bytes)
+_REQUIRED_FIELD = "populations"
+
+
+def _snp_key(rsid: str) -> str:
+    # v2: HASH вместо одной JSON-строки (v1)
+    return f"snp:{rsid}:v2"
+
+
+def _encode_field(field: str, value: Any) -> bytes:
+    return value if field in _RAW_FIELDS else orjson.dumps(value)
+
+
+def _encode_payload(payload: dict) -> Dict[str, bytes]:
+    return {field: _encode_field(field, value) for field, value in payload.items()}
+
+
+def _decode_fields(
+    fields: Sequence[str],
+    values: Sequence[Optional[bytes]],
+) -> Optional[dict]:
+    """
+    Декодирует ответ HMGET в payload; None, если какое-то поле повреждено.
+    """
+    try:
+        return {
+            f: v if f in _RAW_FIELDS else orjson.loads(v)
+            for f, v in zip(fields, values)
+            if v is not None
+        }
+    except orjson.JSONDecodeError:
+        return None
+
+
+# INCR + EXPIRE атомарно на стороне Redis: TTL ставится в том же вызове,
+# что и первый инкремент, поэтому ключ не может "зависнуть" без TTL
+_RATE_LIMIT_LUA = """
+local c = redis.call('INCR', KEYS[1])
+if c == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return c
+"""
+
+# HMGET полей результата + (только при попадании) ZADD/EXPIRE истории —
+# один round-trip на cache hit. Попадание — только если есть обязательное поле.
+# KEYS: snp-ключ, history-ключ; ARGV: score, rsid, ttl истории, обязательное поле, поля...
+_GET_AND_RECORD_LUA = """
+if redis.call('HEXISTS', KEYS[1], ARGV[4]) == 0 then
+    return nil
+end
+local v = redis.call('HMGET', KEYS[1], unpack(ARGV, 5))
+redis.call('ZADD', KEYS[2], ARGV[1], ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return v
+"""
+
+# HSET полей только в существующий HASH: если ключ уже истёк,
+# не создаём новый HASH без TTL и без остальных полей.
+# ARGV: поле1, значение1, поле2, значение2, ...
+_SET_FIELDS_IF_EXISTS_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV))
+return 1
+"""
+
+# DEL только незавершённого результата (без поля PDF): успешный результат
+# параллельного запроса того же rsID не трогаем. ARGV: поле PDF
+_DELETE_INCOMPLETE_LUA = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    return 0
+end
+return redis.call('DEL', KEYS[1])
+"""
+
 
 class CacheManager:
     """
@@ -17,14 +116,46 @@ class CacheManager:
     """
 
     def __init__(self) -> None:
-        self._redis = redis.from_url(settings.redis_url, decode_responses=True)
+        # Без decode_responses: значения приходят как bytes и сразу идут в orjson.loads
+        self._redis = redis.from_url(settings.redis_url)
         self._ttl = settings.cache_ttl  # TTL для SNP результата (24ч по умолчанию)
+        # rsid -> (expires_at, payload); бот работает в одном event loop, блокировки не нужны
+        self._local: OrderedDict[str, Tuple[float, dict]] = OrderedDict()
+        # Script вызывает EVALSHA и сам перезагружает скрипт при NOSCRIPT
+        self._rate_limit_script = self._redis.register_script(_RATE_LIMIT_LUA)
+        self._get_and_record_script = self._redis.register_script(_GET_AND_RECORD_LUA)
+        self._set_fields_script = self._redis.register_script(_SET_FIELDS_IF_EXISTS_LUA)
+        self._delete_incomplete_script = self._redis.register_script(_DELETE_INCOMPLETE_LUA)
 
     # =====================================================================
     # 1. КЭШ SNP РЕЗУЛЬТАТОВ
     # =====================================================================
 
-    async def get_snp_result(self, rsid: str) -> Optional[dict]:
+    def _local_get(self, rsid: str) -> Optional[dict]:
+        entry = self._local.get(rsid)
+        if entry is None:
+            return None
+        expires_at, payload = entry
+        if expires_at < time.monotonic():
+            del self._local[rsid]
+            return None
+        self._local.move_to_end(rsid)
+        return payload
+
+    def _local_put(self, rsid: str, payload: dict) -> None:
+        # pdf_bytes (до 512 КБ) локально не держим: на этой реплике PDF
+        # отдаётся с диска по полю pdf, иначе LRU занимал бы до ~128 МБ
+        local = {f: v for f, v in payload.items() if f not in _RAW_FIELDS}
+        self._local[rsid] = (time.monotonic() + _LOCAL_TTL, local)
+        self._local.move_to_end(rsid)
+        while len(self._local) > _LOCAL_MAX:
+            self._local.popitem(last=False)
+
+    async def get_snp_result(
+        self,
+        rsid: str,
+        fields: Sequence[str] = SNP_FIELDS,
+    ) -> Optional[dict]:
         """
         Возвращает payload:
         {
@@ -34,25 +165,108 @@ class CacheManager:
             "images": [...],
             "pdf": "/app/reports/rs123.pdf"
         }
+
+        Сначала смотрит в локальный кэш процесса, затем в Redis.
+        Из Redis читаются (HMGET) и декодируются только запрошенные поля.
         """
-        key = f"snp:{rsid}:v1"
-        data = await self._redis.get(key)
-        if not data:
+        local = self._local_get(rsid)
+        if local is not None:
+            return {f: local[f] for f in fields if f in local}
+
+        key = _snp_key(rsid)
+        values = await self._redis.hmget(key, list(fields))
+        if not any(values):
             logging.info("No data found in cache")
             return None
 
-        try:
-            return json.loads(data)
-        except json.JSONDecodeError:
+        payload = _decode_fields(fields, values)
+        if payload is None:
+            return None
+
+        # В локальный кэш кладём только полный payload
+        if tuple(fields) == SNP_FIELDS and _REQUIRED_FIELD in payload:
+            self._local_put(rsid, payload)
+        return payload
+
+    async def get_snp_result_and_add_history(
+        self,
+        rsid: str,
+        user_id: int,
+    ) -> Optional[dict]:
+        """
+        То же, что get_snp_result + add_history_entry, но для Redis —
+        одним Lua-скриптом (EVALSHA). История пишется только при попадании в кэш.
+        """
+        local = self._local_get(rsid)
+        if local is not None:
+            await self.add_history_entry(user_id, rsid)
+            return local
+
+        values = await self._get_and_record_script(
+            keys=[_snp_key(rsid), f"history:{user_id}"],
+            args=[time.time(), rsid, _HIST_TTL, _REQUIRED_FIELD, *SNP_FIELDS],
+        )
+        if not values:
+            logging.info("No data found in cache")
+            return None
+
+        payload = _decode_fields(SNP_FIELDS, values)
+        if payload is None:
             return None
 
+        self._local_put(rsid, payload)
+        return payload
+
+    async def get_snp_field(self, rsid: str, field: str) -> Any:
+        """
+        Возвращает одно поле payload (HGET) или None, если его нет в кэше.
+        """
+        local = self._local_get(rsid)
+        if local is not None:
+            return local.get(field)
+
+        value = await self._redis.hget(_snp_key(rsid), field)
+        if value is None:
+            return None
+        decoded = _decode_fields((field,), (value,))
+        return decoded.get(field) if decoded else None
+
+    async def set_snp_fields(self, rsid: str, fields: Dict[str, Any]) -> None:
+        """
+        Дописывает поля в уже сохранённый результат (TTL ключа не меняется).
+        Если результат уже истёк в Redis, ничего не пишет.
+        """
+        args: List[Any] = []
+        for field, value in fields.items():
+            args += (field, _encode_field(field, value))
+        await self._set_fields_script(keys=[_snp_key(rsid)], args=args)
+        local = self._local_get(rsid)
+        if local is not None:
+            local.update((f, v) for f, v in fields.items() if f not in _RAW_FIELDS)
+
+    async def delete_incomplete_result(self, rsid: str, required_field: str = "pdf") -> None:
+        """
+        Удаляет результат из Redis и из локального кэша, только если в нём
+        ещё нет required_field (например, сборка PDF упала).
+        """
+        local = self._local.get(rsid)
+        if local is not None and required_field not in local[1]:
+            del self._local[rsid]
+        await self._delete_incomplete_script(keys=[_snp_key(rsid)], args=[required_field])
+
     async def set_snp_result(self, rsid: str, payload: dict) -> None:
         """
-        payload должен быть сериализуем в JSON.
-        PDF-файл хранится на диске, в Redis кладётся только путь.
+        payload должен быть сериализуем в JSON (через orjson).
+        Каждое поле верхнего уровня хранится отдельным полем HASH.
+        PDF-файл хранится на диске, в Redis кладётся путь; небольшие
+        PDF дополнительно кладутся как bytes в поле pdf_bytes.
         """
-        key = f"snp:{rsid}:v1"
-        await self._redis.set(key, json.dumps(payload), ex=self._ttl)
+        key = _snp_key(rsid)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.hset(key, mapping=_encode_payload(payload))
+            pipe.expire(key, self._ttl)
+            await pipe.execute()
+        self._local_put(rsid, payload)
 
     # =====================================================================
     # 2. ИСТОРИЯ ЗАПРОСОВ (последние 24 часа)
@@ -67,8 +281,11 @@ class CacheManager:
         key = f"history:{user_id}"
         now = time.time()
 
-        await self._redis.zadd(key, {rsid: now})
-        await self._redis.expire(key, 2 * 86400)  # 2 дня
+        # ZADD + EXPIRE одним round-trip
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.zadd(key, {rsid: now})
+            pipe.expire(key, _HIST_TTL)
+            await pipe.execute()
         logging.info("Cached an entry into user history")
 
     async def get_history(self, user_id: int) -> List[str]:
@@ -79,7 +296,7 @@ class CacheManager:
         """
         key = f"history:{user_id}"
         now = time.time()
-        day_ago = now - 86400
+        day_ago = now - _DAY
 
         logging.info("Getting user request history")
         try:
@@ -91,11 +308,11 @@ class CacheManager:
         if not rsids:
             try:
                 legacy = await self._redis.lrange(key, 0, 9)
-                return legacy
+                return [r.decode() for r in legacy]
             except Exception:
                 return []
 
-        return rsids
+        return [r.decode() for r in rsids]
 
     # =====================================================================
     # 3. RATE LIMITING (лимит N запросов в час)
@@ -116,17 +333,14 @@ class CacheManager:
         Логика:
         - ключ = rate:{user_id}:{hour_bucket}
         - hour_bucket = unix_timestamp // 3600
-        - INCR увеличивает счетчик
-        - если это первое увеличение — устанавливаем TTL=3600
+        - Lua-скрипт (EVALSHA) делает INCR и, если это первое увеличение,
+          устанавливает TTL=3600 — атомарно и за один round-trip
         """
         now = int(time.time())
-        hour_bucket = now // 3600
+        hour_bucket = now // _HOUR
         key = f"rate:{user_id}:{hour_bucket}"
 
-        current = await self._redis.incr(key)
-
-        if current == 1:
-            await self._redis.expire(key, 3600)  # живёт 1 час
+        current = int(await self._rate_limit_script(keys=[key], args=[_HOUR]))
 
         remaining = max(limit - current, 0)
         allowed = current <= limit
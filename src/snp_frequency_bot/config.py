@@ -16,6 +16,7 @@ class Settings:
     ncbi_timeout: int = int(os.getenv("NCBI_API_TIMEOUT", 30))
     cache_ttl: int = int(os.getenv("CACHE_TTL", 86400))
     max_requests_per_hour: int = int(os.getenv("MAX_REQUESTS_PER_HOUR", 50))
+    plots_prewarm: bool = os.getenv("SNP_PREWARM", "1") == "1"
 
 
 settings = Settings()
@@ -1,7 +1,30 @@
-from typing import Any, Dict, List
+from bisect import bisect_right
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+import numpy as np
 
 from .snp_analyzer import SnpSummary
 
+# Границы категорий MAF: ultra-rare | rare | low-frequency | common
+_MAF_THRESHOLDS = (0.001, 0.01, 0.05)
+_CATEGORIES = ("ultra-rare", "rare", "low-frequency", "common")
+_CATEGORY_LUT = np.array(_CATEGORIES)
+
+# Начиная с этого числа популяций арифметика считается векторно через NumPy
+_VECTORIZE_MIN_POPULATIONS = 32
+
+
+def _iter_gene_symbols(ann: Dict[str, Any]) -> Iterator[Optional[str]]:
+    """
+    Символы генов из одной аннотации: поле gene/genes бывает dict или list.
+    """
+    gene_info = ann.get("gene") or ann.get("genes")
+    if isinstance(gene_info, dict):
+        yield gene_info.get("symbol")
+    elif isinstance(gene_info, list):
+        for g in gene_info:
+            yield g.get("symbol")
+
 
 def _extract_basic_info(rsid: str, raw: Dict[str, Any]) -> Dict[str, Any]:
     """
@@ -41,19 +64,15 @@ def _extract_basic_info(rsid: str, raw: Dict[str, Any]) -> Dict[str, Any]:
             continue
 
     # 3) Genes: собираем все уникальные символы генов, если есть
+    # (set — для проверки за O(1), list — для сохранения порядка)
+    seen: Set[str] = set()
     genes: List[str] = []
     allele_annotations = primary.get("allele_annotations", []) or []
     for ann in allele_annotations:
-        gene_info = ann.get("gene") or ann.get("genes")
-        if isinstance(gene_info, dict):
-            symbol = gene_info.get("symbol")
-            if symbol and symbol not in genes:
+        for symbol in _iter_gene_symbols(ann):
+            if symbol and symbol not in seen:
+                seen.add(symbol)
                 genes.append(symbol)
-        elif isinstance(gene_info, list):
-            for g in gene_info:
-                symbol = g.get("symbol")
-                if symbol and symbol not in genes:
-                    genes.append(symbol)
 
     if not genes:
         genes = ["-"]
@@ -95,13 +114,8 @@ def _categorize_maf(maf: float) -> str:
     <0.05  low-frequency
     >=0.05 common
     """
-    if maf < 0.001:
-        return "ultra-rare"
-    if maf < 0.01:
-        return "rare"
-    if maf < 0.05:
-        return "low-frequency"
-    return "common"
+    # bisect_right: значение ровно на границе относится к верхней категории
+    return _CATEGORIES[bisect_right(_MAF_THRESHOLDS, maf)]
 
 
 def _build_population_blocks(summary: SnpSummary) -> List[Dict[str, Any]]:
@@ -113,30 +127,45 @@ def _build_population_blocks(summary: SnpSummary) -> List[Dict[str, Any]]:
     - category по maf
     - source(=study) и name(=study)
     """
-    populations: List[Dict[str, Any]] = []
-    for p in summary.populations:
-        p_freq = float(p.freq_ref)
-        q_freq = float(p.freq_alt)
-        maf = float(min(p_freq, q_freq))
+    pops = summary.populations
+    n = len(pops)
+
+    if n < _VECTORIZE_MIN_POPULATIONS:
+        p_freqs = [float(p.freq_ref) for p in pops]
+        q_freqs = [float(p.freq_alt) for p in pops]
+        mafs = [min(p_freq, q_freq) for p_freq, q_freq in zip(p_freqs, q_freqs)]
         # total_alleles ~ 2 * sample_n при диплоидном геноме
-        sample_n = p.total_alleles // 2 if p.total_alleles else 0
-        category = _categorize_maf(maf)
-
-        populations.append(
-            {
-                "name": p.study,
-                "source": p.study,
-                "ref_allele": p.ref_allele,
-                "alt_allele": p.alt_allele,
-                "p": p_freq,
-                "q": q_freq,
-                "maf": maf,
-                "sample_n": sample_n,
-                "category": category,
-            }
+        sample_ns = [p.total_alleles // 2 if p.total_alleles else 0 for p in pops]
+        categories = [_categorize_maf(maf) for maf in mafs]
+    else:
+        p_arr = np.fromiter((p.freq_ref for p in pops), dtype=np.float64, count=n)
+        q_arr = np.fromiter((p.freq_alt for p in pops), dtype=np.float64, count=n)
+        n_arr = np.fromiter((p.total_alleles or 0 for p in pops), dtype=np.int64, count=n)
+        maf_arr = np.minimum(p_arr, q_arr)
+
+        # .tolist() возвращает обычные float/int/str — payload остаётся JSON-сериализуемым
+        p_freqs = p_arr.tolist()
+        q_freqs = q_arr.tolist()
+        mafs = maf_arr.tolist()
+        sample_ns = (n_arr // 2).tolist()
+        categories = _CATEGORY_LUT[np.digitize(maf_arr, _MAF_THRESHOLDS)].tolist()
+
+    return [
+        {
+            "name": p.study,
+            "source": p.study,
+            "ref_allele": p.ref_allele,
+            "alt_allele": p.alt_allele,
+            "p": p_freq,
+            "q": q_freq,
+            "maf": maf,
+            "sample_n": sample_n,
+            "category": category,
+        }
+        for p, p_freq, q_freq, maf, sample_n, category in zip(
+            pops, p_freqs, q_freqs, mafs, sample_ns, categories
         )
-
-    return populations
+    ]
 
 
 def build_extended_summary(
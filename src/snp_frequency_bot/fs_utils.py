@@ -0,0 +1,11 @@
+import os
+from functools import lru_cache
+
+
+@lru_cache(maxsize=128)
+def ensure_dir(path: str) -> None:
+    """
+    os.makedirs(path, exist_ok=True), но для каждого каталога только один раз
+    за жизнь процесса: plots/ и reports/ одни и те же на всех запросах.
+    """
+    os.makedirs(path, exist_ok=True)
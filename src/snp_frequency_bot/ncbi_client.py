@@ -1,6 +1,7 @@
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 import aiohttp
+import orjson
 
 from .config import settings
 
@@ -17,23 +18,56 @@ class NcbiUnavailableError(NcbiError):
     pass
 
 
+# Общая сессия на весь процесс: переиспользуем TCP/TLS-соединения (keep-alive)
+_session: Optional[aiohttp.ClientSession] = None
+
+
+async def _get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=100,
+            limit_per_host=20,
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+        )
+        timeout = aiohttp.ClientTimeout(total=settings.ncbi_timeout)
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+            # ответы refsnp большие; aiohttp сам распаковывает gzip
+            headers={"Accept-Encoding": "gzip"},
+        )
+    return _session
+
+
+async def close_session() -> None:
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
 async def fetch_snp(rsid: str) -> Dict[str, Any]:
     if not rsid.startswith("rs"):
         raise ValueError("rsid must start with 'rs'")
     numeric_id = rsid[2:]
     url = f"https://api.ncbi.nlm.nih.gov/variation/v0/refsnp/{numeric_id}"
 
-    timeout = aiohttp.ClientTimeout(total=settings.ncbi_timeout)
-
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        try:
-            async with session.get(url) as resp:
-                if resp.status == 404:
-                    raise SnpNotFoundError(f"SNP {rsid} not found")
-                if resp.status >= 500:
-                    raise NcbiUnavailableError(f"NCBI API error {resp.status}")
-                if resp.status != 200:
-                    raise NcbiError(f"Unexpected status code {resp.status}")
-                return await resp.json()
-        except aiohttp.ClientError as e:
-            raise NcbiUnavailableError(f"Network error: {e}") from e
+    session = await _get_session()
+    try:
+        async with session.get(url) as resp:
+            if resp.status == 404:
+                raise SnpNotFoundError(f"SNP {rsid} not found")
+            if resp.status >= 500:
+                raise NcbiUnavailableError(f"NCBI API error {resp.status}")
+            if resp.status != 200:
+                raise NcbiError(f"Unexpected status code {resp.status}")
+            body = await resp.read()
+    except aiohttp.ClientError as e:
+        raise NcbiUnavailableError(f"Network error: {e}") from e
+
+    try:
+        return orjson.loads(body)
+    except orjson.JSONDecodeError as e:
+        raise NcbiError("Bad JSON") from e
@@ -1,5 +1,8 @@
 import os
-from typing import Dict, Any, List
+import struct
+import threading
+from io import BytesIO
+from typing import Any, Callable, Dict, List, Tuple, Union
 
 from reportlab.lib.pagesizes import A4
 from reportlab.platypus import (
@@ -10,39 +13,38 @@ from reportlab.platypus import (
     Table,
     TableStyle,
     PageBreak,
+    Flowable,
 )
-from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.lib.styles import StyleSheet1, getSampleStyleSheet
 from reportlab.lib import colors
 from reportlab.lib.units import cm
+from reportlab.lib.utils import ImageReader
 
-from PIL import Image as PilImage
+from .fs_utils import ensure_dir
 
 
-def build_pdf_report(
-    rsid: str,
-    extended_summary: Dict[str, Any],
-    images: List[str],
-    output_path: str,
-) -> str:
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def _png_size(data: bytes) -> Tuple[int, int]:
     """
-    Читаемый PDF-отчёт:
-    - страница 1: basic info + таблица + предупреждения
-    - дальше: по одному графику на страницу, без сплющивания (с сохранением пропорций)
+    Ширина и высота PNG из заголовка IHDR (первые 24 байта), без декодирования.
     """
-    styles = getSampleStyleSheet()
+    if len(data) < 24 or not data.startswith(_PNG_SIGNATURE) or data[12:16] != b"IHDR":
+        raise ValueError("not a PNG file")
+    return struct.unpack(">II", data[16:24])
 
-    doc = SimpleDocTemplate(
-        output_path,
-        pagesize=A4,
-        leftMargin=1.5 * cm,
-        rightMargin=1.5 * cm,
-        topMargin=1.5 * cm,
-        bottomMargin=1.5 * cm,
-    )
-    page_width, page_height = A4
-    frame_width = page_width - doc.leftMargin - doc.rightMargin
 
-    story = []
+def _build_story_head(
+    rsid: str,
+    extended_summary: Dict[str, Any],
+    styles: StyleSheet1,
+    frame_width: float,
+) -> List[Flowable]:
+    """
+    Первая страница отчёта: заголовок, basic info, таблица популяций, предупреждения.
+    """
+    story: List[Flowable] = []
 
     basic = extended_summary.get("basic_info") or {}
     pops = extended_summary.get("populations") or []
@@ -73,21 +75,22 @@ def build_pdf_report(
     if pops:
         story.append(Paragraph("Population frequencies", styles["Heading2"]))
 
+        get = dict.get
         table_data: List[List[str]] = [
-            ["Population", "Source", "p", "q", "MAF", "N samples", "Category"]
-        ]
-        for p in pops:
-            table_data.append(
+            ["Population", "Source", "p", "q", "MAF", "N samples", "Category"],
+            *(
                 [
-                    p.get("name", "-"),
-                    p.get("source", "-"),
-                    f"{p.get('p', 0):.4f}",
-                    f"{p.get('q', 0):.4f}",
-                    f"{p.get('maf', 0):.4f}",
-                    str(p.get("sample_n", 0)),
-                    p.get("category", "-"),
+                    get(p, "name", "-"),
+                    get(p, "source", "-"),
+                    "%.4f" % get(p, "p", 0),
+                    "%.4f" % get(p, "q", 0),
+                    "%.4f" % get(p, "maf", 0),
+                    str(get(p, "sample_n", 0)),
+                    get(p, "category", "-"),
                 ]
-            )
+                for p in pops
+            ),
+        ]
 
         col_widths = [
             frame_width * 0.20,  # Population
@@ -121,9 +124,26 @@ def build_pdf_report(
             story.append(Paragraph(f"- {w}", styles["Normal"]))
         story.append(Spacer(1, 0.6 * cm))
 
+    return story
+
+
+def _append_graphs(
+    story: List[Flowable],
+    images: List[str],
+    styles: StyleSheet1,
+    frame_width: float,
+) -> None:
+    """
+    Добавляет в story графики, каждый на отдельной странице.
+    """
     # --- 4. Graphs: каждый график на отдельной странице, с сохранением пропорций ---
     for img_path in images:
-        if not os.path.exists(img_path):
+        # Файл читаем один раз: размеры берём из байтов, их же отдаём ReportLab.
+        # Отдельный os.path.exists не нужен — open() и есть проверка существования
+        try:
+            with open(img_path, "rb") as f:
+                data = f.read()
+        except OSError:
             continue
 
         story.append(PageBreak())
@@ -132,11 +152,13 @@ def build_pdf_report(
         story.append(Spacer(1, 0.5 * cm))
 
         try:
-            with PilImage.open(img_path) as im:
-                orig_width, orig_height = im.size
+            orig_width, orig_height = _png_size(data)
         except Exception:
-            # fallback: если не удалось прочитать, используем фиксированное соотношение
-            orig_width, orig_height = 1000, 700
+            try:
+                orig_width, orig_height = ImageReader(BytesIO(data)).getSize()
+            except Exception:
+                # fallback: если не удалось прочитать, используем фиксированное соотношение
+                orig_width, orig_height = 1000, 700
 
         if orig_width <= 0:
             aspect = 0.7
@@ -146,9 +168,57 @@ def build_pdf_report(
         img_width = frame_width
         img_height = frame_width * aspect
 
-        story.append(Image(img_path, width=img_width, height=img_height))
+        story.append(Image(BytesIO(data), width=img_width, height=img_height))
+
+
+def build_pdf_report(
+    rsid: str,
+    extended_summary: Dict[str, Any],
+    images: Union[List[str], Callable[[], List[str]]],
+    output_path: str,
+) -> str:
+    """
+    Читаемый PDF-отчёт:
+    - страница 1: basic info + таблица + предупреждения
+    - дальше: по одному графику на страницу, без сплющивания (с сохранением пропорций)
 
-    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
-    doc.build(story)
+    images — список путей к PNG или функция, которая его вернёт
+    (например, Future.result от параллельного generate_plots).
+    """
+    styles = getSampleStyleSheet()
+
+    # Пишем во временный файл и атомарно переименовываем: параллельный запрос
+    # того же rsID никогда не прочитает недописанный reports/{rsid}.pdf
+    tmp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    doc = SimpleDocTemplate(
+        tmp_path,
+        pagesize=A4,
+        leftMargin=1.5 * cm,
+        rightMargin=1.5 * cm,
+        topMargin=1.5 * cm,
+        bottomMargin=1.5 * cm,
+    )
+    page_width, page_height = A4
+    frame_width = page_width - doc.leftMargin - doc.rightMargin
+
+    story = _build_story_head(rsid, extended_summary, styles, frame_width)
+
+    # images может быть функцией: графики ещё рендерятся в другом потоке,
+    # и ждать их нужно только после того, как собрана текстовая часть
+    if callable(images):
+        images = images()
+
+    _append_graphs(story, images, styles, frame_width)
+
+    ensure_dir(os.path.dirname(output_path) or ".")
+    try:
+        doc.build(story)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
 
     return output_path
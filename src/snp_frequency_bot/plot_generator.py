@@ -1,94 +1,138 @@
 import os
-from typing import List
+import threading
+from typing import List, Tuple
+from .config import settings
+from .fs_utils import ensure_dir
 from .snp_analyzer import SnpSummary
 
 import matplotlib
-matplotlib.use("Agg")  # headless backend
-
-import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib import font_manager
+from matplotlib.axes import Axes
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 
 PLOTS_DIR = "plots"
 
-def generate_plots(summary: SnpSummary) -> List[str]:
-    os.makedirs(PLOTS_DIR, exist_ok=True)
+# Явный шрифт: без поиска fallback-шрифтов при каждом рендере текста
+matplotlib.rcParams["font.family"] = "DejaVu Sans"
+
+# Стили столбцов задаём явно (цвета — как у стандартного цикла C0/C1),
+# чтобы bar() не обращался к color cycle и rcParams на каждом вызове
+_BAR_KW_REF = dict(color="#1f77b4", width=0.8, label="Ref allele")
+_BAR_KW_ALT = dict(color="#ff7f0e", width=0.8, label="Alt allele")
+_BAR_KW_MAF = dict(color="#1f77b4", width=0.7)
+
+# dpi=100 и быстрый zlib (compress_level=1): PNG чуть больше, но savefig заметно быстрее
+_DPI = 100
+_PNG_KW = {"pil_kwargs": {"compress_level": 1}}
+
+
+def _make_figure(figsize: Tuple[float, float], **adjust: float) -> Tuple[Figure, Axes]:
+    # Figure + FigureCanvasAgg напрямую, без pyplot (headless, без глобального состояния)
+    fig = Figure(figsize=figsize, dpi=_DPI)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    if adjust:
+        # фиксированные отступы вместо tight_layout() на каждом вызове
+        fig.subplots_adjust(**adjust)
+    return fig, ax
+
+
+def _make_freq_figure() -> Tuple[Figure, Axes, Axes]:
+    # Аллельные частоты (сверху) и MAF (снизу) на одной картинке с общей осью X:
+    # один savefig/PNG-encode вместо двух
+    fig = Figure(figsize=(14, 12), dpi=_DPI)
+    FigureCanvasAgg(fig)
+    ax_bar, ax_maf = fig.subplots(2, 1, sharex=True)
+    fig.subplots_adjust(bottom=0.2, left=0.08, right=0.98, top=0.95, hspace=0.15)
+    return fig, ax_bar, ax_maf
+
+
+# Фигуры создаются один раз и переиспользуются: между вызовами только ax.cla()
+_FREQ_FIG, _BAR_AX, _MAF_AX = _make_freq_figure()
+_PIE_FIG, _PIE_AX = _make_figure((6, 6))  # три сектора — большой холст не нужен
+
+# generate_plots может вызываться из разных потоков — фигуры общие
+_FIG_LOCK = threading.Lock()
+
+
+def _prewarm() -> None:
+    # Первая отрисовка строит кэш шрифтов (сотни мс) — делаем это при импорте,
+    # а не на первом запросе пользователя
+    font_manager.fontManager.findfont("DejaVu Sans")
+    for fig in (_FREQ_FIG, _PIE_FIG):
+        fig.canvas.draw()
+
+
+if settings.plots_prewarm:
+    _prewarm()
+
+
+def generate_plots(summary: SnpSummary, base_dir: str = PLOTS_DIR) -> List[str]:
+    ensure_dir(base_dir)
 
     paths: List[str] = []
 
-    studies = [p.study for p in summary.populations]
-    ref_freqs = [p.freq_ref for p in summary.populations]
-    alt_freqs = [p.freq_alt for p in summary.populations]
-
-    # ============================================================
-    # 1) Барчарт аллельных частот (stacked bar)
-    # ============================================================
-    if studies:
-        fig, ax = plt.subplots(figsize=(14, 9), dpi=150)
-
-        x = range(len(studies))
-        ax.bar(x, ref_freqs, label="Ref allele", width=0.8)
-        ax.bar(x, alt_freqs, bottom=ref_freqs, label="Alt allele", width=0.8)
-
-        ax.set_title(f"Allele frequencies for {summary.rsid}")
-        ax.set_ylabel("Allele frequency")
-        ax.set_xticks(list(x))
-        ax.set_xticklabels(studies, rotation=70, ha="right", fontsize=8)
-
-        ax.legend()
-        plt.tight_layout()
-
-        bar_path = os.path.join(PLOTS_DIR, f"{summary.rsid}_alleles.png")
-        fig.savefig(bar_path)
-        plt.close(fig)
-        paths.append(bar_path)
-
-    # ============================================================
-    # 2) MAF по популяциям
-    # ============================================================
-    if studies:
-        maf_vals = [min(r, a) for r, a in zip(ref_freqs, alt_freqs)]
-
-        fig_maf, ax_maf = plt.subplots(figsize=(14, 9), dpi=150)
-
-        x = range(len(studies))
-        ax_maf.bar(x, maf_vals, width=0.7)
-
-        ax_maf.set_title(f"Minor Allele Frequency (MAF) for {summary.rsid}")
-        ax_maf.set_ylabel("MAF")
-        ax_maf.set_xticks(list(x))
-        ax_maf.set_xticklabels(studies, rotation=70, ha="right", fontsize=8)
-
-        plt.tight_layout()
-
-        maf_path = os.path.join(PLOTS_DIR, f"{summary.rsid}_maf.png")
-        fig_maf.savefig(maf_path)
-        plt.close(fig_maf)
-        paths.append(maf_path)
-
-    # ============================================================
-    # 3) Pie chart генотипных частот по первой популяции (если есть)
-    # ============================================================
-    if summary.populations:
-        p0 = summary.populations[0]
-        gf = p0.genotype_freqs
-
-        if gf:
-            fig2, ax2 = plt.subplots(figsize=(10, 10), dpi=150)
-
-            labels = ["0/0", "0/1", "1/1"]
-            sizes = [gf.hom_ref, gf.het, gf.hom_alt]
-
-            ax2.pie(
-                sizes,
-                labels=[f"{l}\n{v*100:.1f}%" for l, v in zip(labels, sizes)],
-                autopct=None,
-            )
-            ax2.set_title(f"Genotype frequencies ({p0.study}) for {summary.rsid}")
-
-            plt.tight_layout()
-
-            pie_path = os.path.join(PLOTS_DIR, f"{summary.rsid}_genotypes.png")
-            fig2.savefig(pie_path)
-            plt.close(fig2)
-            paths.append(pie_path)
+    pops = summary.populations
+    n = len(pops)
+    studies = [p.study for p in pops]
+    ref_freqs = np.fromiter((p.freq_ref for p in pops), dtype=np.float64, count=n)
+    alt_freqs = np.fromiter((p.freq_alt for p in pops), dtype=np.float64, count=n)
+    x = np.arange(n)
+
+    with _FIG_LOCK:
+        # ============================================================
+        # 1) Аллельные частоты (stacked bar) + 2) MAF по популяциям
+        # ============================================================
+        if studies:
+            ax = _BAR_AX
+            ax_maf = _MAF_AX
+            ax.cla()
+            ax_maf.cla()
+
+            ax.bar(x, ref_freqs, **_BAR_KW_REF)
+            ax.bar(x, alt_freqs, bottom=ref_freqs, **_BAR_KW_ALT)
+
+            ax.set_title(f"Allele frequencies for {summary.rsid}")
+            ax.set_ylabel("Allele frequency")
+            ax.legend()
+
+            ax_maf.bar(x, np.minimum(ref_freqs, alt_freqs), **_BAR_KW_MAF)
+
+            ax_maf.set_title(f"Minor Allele Frequency (MAF) for {summary.rsid}")
+            ax_maf.set_ylabel("MAF")
+            # ось X общая — подписи исследований только у нижнего графика
+            ax_maf.set_xticks(x)
+            ax_maf.set_xticklabels(studies, rotation=70, ha="right", fontsize=8)
+
+            freq_path = os.path.join(base_dir, f"{summary.rsid}_frequencies.png")
+            _FREQ_FIG.canvas.print_png(freq_path, **_PNG_KW)
+            paths.append(freq_path)
+
+        # ============================================================
+        # 3) Pie chart генотипных частот по первой популяции (если есть)
+        # ============================================================
+        if summary.populations:
+            p0 = summary.populations[0]
+            gf = p0.genotype_freqs
+
+            if gf:
+                ax2 = _PIE_AX
+                ax2.cla()
+
+                labels = ["0/0", "0/1", "1/1"]
+                sizes = [gf.hom_ref, gf.het, gf.hom_alt]
+
+                ax2.pie(
+                    sizes,
+                    labels=[f"{l}\n{v*100:.1f}%" for l, v in zip(labels, sizes)],
+                    autopct=None,
+                )
+                ax2.set_title(f"Genotype frequencies ({p0.study}) for {summary.rsid}")
+
+                pie_path = os.path.join(base_dir, f"{summary.rsid}_genotypes.png")
+                _PIE_FIG.canvas.print_png(pie_path, **_PNG_KW)
+                paths.append(pie_path)
 
     return paths
@@ -1,18 +1,26 @@
-from dataclasses import dataclass, asdict
-from typing import Any, Dict, List
+from dataclasses import dataclass
+from typing import Any, Dict, List, NamedTuple, Tuple
 
+import numpy as np
 
-@dataclass
-class GenotypeFrequencies:
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional; fall back to plain NumPy if not installed
+    njit = None
+
+
+class GenotypeFrequencies(NamedTuple):
+    # NamedTuple: создаётся заметно быстрее dataclass, объект всё равно write-once
     hom_ref: float
     het: float
     hom_alt: float
 
     def to_dict(self) -> dict:
-        return asdict(self)
+        return self._asdict()
 
 
-@dataclass
+@dataclass(slots=True)
 class PopulationSummary:
     study: str
     ref_allele: str
@@ -23,23 +31,68 @@ class PopulationSummary:
     total_alleles: int
 
     def to_dict(self) -> dict:
-        d = asdict(self)
-        d["genotype_freqs"] = self.genotype_freqs.to_dict()
-        return d
-
-
-@dataclass
+        # Только примитивы Python: результат уходит прямо в orjson.dumps
+        # (кэш Redis) без default-хуков и повторного обхода
+        gf = self.genotype_freqs
+        return {
+            "study": self.study,
+            "ref_allele": self.ref_allele,
+            "alt_allele": self.alt_allele,
+            "freq_ref": float(self.freq_ref),
+            "freq_alt": float(self.freq_alt),
+            "genotype_freqs": {
+                "hom_ref": float(gf.hom_ref),
+                "het": float(gf.het),
+                "hom_alt": float(gf.hom_alt),
+            },
+            "total_alleles": int(self.total_alleles),
+        }
+
+
+@dataclass(slots=True)
 class SnpSummary:
     rsid: str
     populations: List[PopulationSummary]
 
 
-def _compute_hardy_weinberg(p: float, q: float) -> GenotypeFrequencies:
-    return GenotypeFrequencies(
-        hom_ref=p * p,
-        het=2 * p * q,
-        hom_alt=q * q,
-    )
+def _build_hw_numpy(
+    alt: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Частота референсного аллеля и генотипы по Харди–Вайнбергу сразу
+    для всех популяций: (p, p², 2pq, q²), где q — частота alt-аллеля.
+    """
+    ref = np.maximum(0.0, 1.0 - alt)
+    return ref, ref * ref, 2 * ref * alt, alt * alt
+
+
+def _build_hw_loop(
+    alt: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # Один проход по всем популяциям без промежуточных массивов;
+    # компилируется numba (см. ниже)
+    n = alt.shape[0]
+    ref = np.empty(n)
+    hom_ref = np.empty(n)
+    het = np.empty(n)
+    hom_alt = np.empty(n)
+    for i in range(n):
+        q = alt[i]
+        p = max(0.0, 1.0 - q)
+        ref[i] = p
+        hom_ref[i] = p * p
+        het[i] = 2 * p * q
+        hom_alt[i] = q * q
+    return ref, hom_ref, het, hom_alt
+
+
+if njit is not None:
+    # Явная сигнатура — компиляция сразу при импорте, а не на первом cache miss
+    # в event loop. Без cache=True: on-disk кэш numba пишется в __pycache__
+    # с именем импортирующего модуля и ломается при импорте под другим именем
+    _build_hw = njit("UniTuple(float64[:], 4)(float64[:])", fastmath=True)(_build_hw_loop)
+else:
+    _build_hw = _build_hw_numpy
 
 
 def summarize_snp(rsid: str, raw: Dict[str, Any]) -> SnpSummary:
@@ -53,11 +106,21 @@ def summarize_snp(rsid: str, raw: Dict[str, Any]) -> SnpSummary:
       MAF = allele_count / total_count
       ref_allele = observation.deleted_sequence
       alt_allele = observation.inserted_sequence
-    """
-    primary = raw.get("primary_snapshot_data", {})
-    allele_annotations = primary.get("allele_annotations", [])
 
-    populations: List[PopulationSummary] = []
+    Сначала собираем валидные записи, затем считаем частоты и
+    Харди–Вайнберга одним векторным проходом NumPy.
+    """
+    # Пустой/урезанный ответ (частый случай) — сразу пустой результат
+    primary = raw.get("primary_snapshot_data")
+    if not primary:
+        return SnpSummary(rsid=rsid, populations=[])
+    allele_annotations = primary.get("allele_annotations")
+    if not allele_annotations:
+        return SnpSummary(rsid=rsid, populations=[])
+
+    # (study, ref_allele, alt_allele, allele_count, total_count)
+    entries: List[Tuple[str, str, str, float, float]] = []
+    entries_append = entries.append
 
     for ann in allele_annotations:
         freqs = ann.get("frequency") or []
@@ -65,9 +128,6 @@ def summarize_snp(rsid: str, raw: Dict[str, Any]) -> SnpSummary:
             obs = freq.get("observation") or {}
             study = freq.get("study_name") or "unknown"
 
-            ref_seq = obs.get("deleted_sequence")
-            alt_seq = obs.get("inserted_sequence")
-
             allele_count = freq.get("allele_count")
             total_count = freq.get("total_count")
 
@@ -81,29 +141,49 @@ def summarize_snp(rsid: str, raw: Dict[str, Any]) -> SnpSummary:
             try:
                 allele_count = float(allele_count)
                 total_count = float(total_count)
-                maf = allele_count / total_count
-            except (TypeError, ValueError, ZeroDivisionError):
+            except (TypeError, ValueError):
+                continue
+            if total_count == 0:
                 continue
 
             # если каких-то последовательностей нет — всё равно берём, как есть
-            ref_allele = ref_seq or "-"
-            alt_allele = alt_seq or "-"
-
-            alt_freq = float(maf)
-            ref_freq = max(0.0, 1.0 - alt_freq)
-
-            geno = _compute_hardy_weinberg(ref_freq, alt_freq)
-
-            populations.append(
-                PopulationSummary(
-                    study=study,
-                    ref_allele=ref_allele,
-                    alt_allele=alt_allele,
-                    freq_ref=ref_freq,
-                    freq_alt=alt_freq,
-                    genotype_freqs=geno,
-                    total_alleles=int(total_count),
+            entries_append(
+                (
+                    study,
+                    obs.get("deleted_sequence") or "-",
+                    obs.get("inserted_sequence") or "-",
+                    allele_count,
+                    total_count,
                 )
             )
 
+    n = len(entries)
+    ac = np.fromiter((e[3] for e in entries), dtype=np.float64, count=n)
+    tc = np.fromiter((e[4] for e in entries), dtype=np.float64, count=n)
+
+    # Python собирает только массивы; числовое ядро — в _build_hw
+    alt = ac / tc
+    ref, hom_ref, het, hom_alt = _build_hw(alt)
+
+    # .tolist() — обычные float, чтобы to_dict() оставался JSON-сериализуемым
+    populations = [
+        PopulationSummary(
+            study=study,
+            ref_allele=ref_allele,
+            alt_allele=alt_allele,
+            freq_ref=fr,
+            freq_alt=fa,
+            genotype_freqs=GenotypeFrequencies(hom_ref=hr, het=he, hom_alt=ha),
+            total_alleles=int(total_count),
+        )
+        for (study, ref_allele, alt_allele, _, total_count), fr, fa, hr, he, ha in zip(
+            entries,
+            ref.tolist(),
+            alt.tolist(),
+            hom_ref.tolist(),
+            het.tolist(),
+            hom_alt.tolist(),
+        )
+    ]
+
     return SnpSummary(rsid=rsid, populations=populations)